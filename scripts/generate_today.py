@@ -5,15 +5,20 @@ B1: Vercel public/today.json を毎日自動生成するバッチ
 - 3枠（market/policy/tech）で分散して選定
 - OpenAIがあれば分析JSON（score含む）を生成
 - OpenAIが無ければフォールバック形式で生成
-- public/today.json と public/archive/YYYY-MM-DD.json を出力
+- public/today.json と public/archive/YYYY-MM-DD.json.gz を出力
 """
 
-import os, json, re, time
+import os, json, re, gzip, hashlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timezone
 from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
 
 import feedparser
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dateutil import parser as date_parser
 
 
@@ -42,10 +47,15 @@ AI_TECH_RSS_FEEDS = {
 OUT_PATH = "public/today.json"
 ARCHIVE_DIR = "public/archive"
 
+# 条件付きGET用のフィードキャッシュ（Actionsでは actions/cache で実行間に引き継ぐ）
+FEED_CACHE_DIR = ".cache/feeds"
+FEED_CACHE_INDEX = f"{FEED_CACHE_DIR}/index.json"
+
 TIMEOUT = 12
 PER_FEED_LIMIT = 12
 TOTAL_CANDIDATES = 80
-SLEEP_BETWEEN_FEEDS = 0.6
+PROMPT_SUMMARY_CHARS = 300
+FETCH_WORKERS = 8
 
 # OpenAI（任意）
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "").strip()
@@ -56,7 +66,17 @@ OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini").strip()
 # URL正規化
 # =========================
 def normalize_url(url: str) -> str:
-    u = urlparse((url or "").strip())
+    url = (url or "").strip()
+    # 大半のURLはクエリ/フラグメントなし：文字列操作だけで済ませる
+    scheme, sep, rest = url.partition("://")
+    if sep and scheme.isalpha() and not any(c in rest for c in "?#;"):
+        netloc, slash, path = rest.partition("/")
+        scheme = scheme.lower()
+        if scheme == "http":
+            scheme = "https"
+        return f"{scheme}://{netloc.lower()}{(slash + path).rstrip('/') or '/'}"
+
+    u = urlparse(url)
     q = [(k, v) for k, v in parse_qsl(u.query, keep_blank_values=True) if not k.lower().startswith("utm_")]
     query = urlencode(q)
     path = u.path.rstrip("/") or "/"
@@ -80,6 +100,15 @@ def safe_date(s: str):
 
 def pick_published(entry):
     # feedparser entryはdictっぽい
+    # *_parsed は feedparser がUTCの struct_time に正規化済みなので、まずそれを使う
+    for k in ("published_parsed", "updated_parsed", "created_parsed"):
+        st = entry.get(k)
+        if st:
+            try:
+                return datetime(*st[:6], tzinfo=timezone.utc)
+            except (TypeError, ValueError):
+                pass
+    # 取れなかった時だけ文字列をdateutilで解釈（遅いので最後の手段）
     for k in ("published", "updated", "created"):
         v = entry.get(k)
         dt = safe_date(v)
@@ -88,11 +117,12 @@ def pick_published(entry):
     return None
 
 
+_TAG_RE = re.compile(r"<[^>]+>")
+_WS_RE = re.compile(r"\s+")
+
+
 def strip_html(s: str) -> str:
-    s = s or ""
-    s = re.sub(r"<[^>]+>", " ", s)
-    s = re.sub(r"\s+", " ", s).strip()
-    return s
+    return _WS_RE.sub(" ", _TAG_RE.sub(" ", s or "")).strip()
 
 
 # =========================
@@ -108,29 +138,42 @@ AI_KEYWORDS = [
     "生成ai", "人工知能", "大規模言語モデル", "推論", "学習", "規制", "半導体"
 ]
 
-def looks_ai_related(title: str, summary: str) -> bool:
-    blob = f"{title} {summary}".lower()
-    return any(k in blob for k in AI_KEYWORDS)
+def keyword_regex(keywords) -> "re.Pattern[str]":
+    # 部分一致のキーワード群を1本の正規表現にまとめる（文字列の走査は1回で済む）
+    # 候補は 11フィード×PER_FEED_LIMIT 程度なのでこれで十分。
+    # 数千件規模に増やすなら、全候補をまとめて走査する Aho-Corasick 等を検討する
+    return re.compile("|".join(map(re.escape, keywords)))
+
+
+AI_RE = keyword_regex(AI_KEYWORDS)
+
+
+def looks_ai_related(title_lc: str, summary_lc: str) -> bool:
+    # 小文字化済みの文字列を受け取る。短いタイトルで当たれば長い要約は走査しない
+    return AI_RE.search(title_lc) is not None or AI_RE.search(summary_lc) is not None
 
 
 # =========================
 # 3枠（market/policy/tech）推定
 # =========================
-def infer_bucket(title: str, summary: str) -> str:
-    t = (title + " " + summary).lower()
+MARKET_KEYWORDS = ["funding", "valuation", "investment", "ipo", "earnings", "revenue",
+                   "acquisition", "merger", "deal", "partnership", "pricing", "layoff"]
+POLICY_KEYWORDS = ["regulation", "ai act", "law", "policy", "government", "ban",
+                   "copyright", "antitrust", "export", "controls", "sanction", "compliance"]
+TECH_KEYWORDS = ["model", "release", "benchmark", "training", "inference", "agent",
+                 "chip", "gpu", "architecture", "open source", "dataset", "token", "context"]
 
-    market = ["funding", "valuation", "investment", "ipo", "earnings", "revenue",
-              "acquisition", "merger", "deal", "partnership", "pricing", "layoff"]
-    policy = ["regulation", "ai act", "law", "policy", "government", "ban",
-              "copyright", "antitrust", "export", "controls", "sanction", "compliance"]
-    tech = ["model", "release", "benchmark", "training", "inference", "agent",
-            "chip", "gpu", "architecture", "open source", "dataset", "token", "context"]
+MARKET_RE = keyword_regex(MARKET_KEYWORDS)
+POLICY_RE = keyword_regex(POLICY_KEYWORDS)
+TECH_RE = keyword_regex(TECH_KEYWORDS)
 
-    if any(k in t for k in policy):
+
+def infer_bucket(blob_lc: str) -> str:
+    if POLICY_RE.search(blob_lc):
         return "policy"
-    if any(k in t for k in market):
+    if MARKET_RE.search(blob_lc):
         return "market"
-    if any(k in t for k in tech):
+    if TECH_RE.search(blob_lc):
         return "tech"
     return "tech"
 
@@ -144,20 +187,92 @@ def source_priority(name: str) -> int:
     return 3
 
 
-def fetch_feed(name: str, url: str):
+# フィード名は固定なので、優先度は読み込み時に1回だけ計算しておく
+SOURCE_PRIORITY = {name: source_priority(name) for name in AI_TECH_RSS_FEEDS}
+
+
+# HTTPはフィード取得ワーカーとOpenAI呼び出しで1つのSessionを共有（TCP/TLS接続を再利用）
+# 一時的な 429/5xx は軽くバックオフして再試行（POSTはurllib3の既定で再試行対象外）
+SESSION = requests.Session()
+SESSION.headers.update({"User-Agent": "AIImpactBriefBot/1.0"})
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=16,
+    max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+))
+
+
+def load_feed_cache():
+    try:
+        with open(FEED_CACHE_INDEX, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_feed_cache(cache):
+    os.makedirs(FEED_CACHE_DIR, exist_ok=True)
+    with open(FEED_CACHE_INDEX, "w", encoding="utf-8") as f:
+        json.dump(cache, f, ensure_ascii=False, indent=2)
+
+
+def feed_body_path(url: str) -> str:
+    return f"{FEED_CACHE_DIR}/{hashlib.sha1(url.encode('utf-8')).hexdigest()}.xml"
+
+
+def fetch_feed(name: str, url: str, cache):
     # feedparserのtimeout不安定対策：requestsで取ってからparse
-    r = requests.get(url, timeout=TIMEOUT, headers={"User-Agent": "AIImpactBriefBot/1.0"})
+    headers = {}
+    body_path = feed_body_path(url)
+    cached = cache.get(url) or {}
+    if os.path.exists(body_path):
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+    r = SESSION.get(url, timeout=TIMEOUT, headers=headers)
+    if r.status_code == 304:
+        # 前回から更新なし：保存済みの本文を使う
+        with open(body_path, "rb") as f:
+            return name, feedparser.parse(f.read())
     r.raise_for_status()
-    return feedparser.parse(r.text)
+
+    os.makedirs(FEED_CACHE_DIR, exist_ok=True)
+    with open(body_path, "wb") as f:
+        f.write(r.content)
+    # ワーカーごとにキー（URL）が異なるので、ロックなしで書き込んでよい
+    cache[url] = {"etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified")}
+    # bytesのまま渡す（文字コード判定はfeedparserに任せ、str経由のデコードを省く）
+    return name, feedparser.parse(r.content)
 
 
-def collect_candidates():
+def collect_candidates(now: datetime):
     items = []
     seen_urls = set()
 
-    for name, url in AI_TECH_RSS_FEEDS.items():
+    # 取得は並列（ホストがすべて別なのでsleep不要）
+    feeds = {}
+    cache = load_feed_cache()
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as pool:
+        futures = {pool.submit(fetch_feed, n, u, cache): n for n, u in AI_TECH_RSS_FEEDS.items()}
+        for fut in as_completed(futures):
+            try:
+                name, feed = fut.result()
+                feeds[name] = feed
+            except Exception as ex:
+                print(f"[WARN] feed failed: {futures[fut]} -> {ex}")
+    try:
+        save_feed_cache(cache)
+    except OSError as ex:
+        print(f"[WARN] feed cache save failed: {ex}")
+
+    # 集約はメインスレッドで、定義順に処理（重複除外の結果を実行ごとに安定させる）
+    for name in AI_TECH_RSS_FEEDS:
+        if name not in feeds:
+            continue
+        feed = feeds[name]
         try:
-            feed = fetch_feed(name, url)
             entries = getattr(feed, "entries", []) or []
             for e in entries[:PER_FEED_LIMIT]:
                 link = getattr(e, "link", None) or e.get("link")
@@ -172,34 +287,31 @@ def collect_candidates():
                 summary = strip_html(e.get("summary", "") or e.get("description", "") or "")
                 t = strip_html(str(title))
 
-                if not looks_ai_related(t, summary):
+                title_lc = t.lower()
+                summary_lc = summary.lower()
+                if not looks_ai_related(title_lc, summary_lc):
                     continue
 
-                published_dt = pick_published(e) or datetime.now(timezone.utc)
+                published_dt = pick_published(e) or now
 
                 items.append({
                     "source": name,
                     "original_title": t,
                     "original_url": nurl,
                     "published_at": published_dt.isoformat(),
+                    "_ts": published_dt.timestamp(),
                     "summary_raw": summary[:1500],
-                    "bucket": infer_bucket(t, summary),
-                    "priority": source_priority(name),
+                    "bucket": infer_bucket(title_lc + " " + summary_lc),
+                    "priority": SOURCE_PRIORITY[name],
                 })
                 seen_urls.add(nurl)
-
-            time.sleep(SLEEP_BETWEEN_FEEDS)
         except Exception as ex:
             print(f"[WARN] feed failed: {name} -> {ex}")
 
-    # 新しさ優先、ただし priority は強く効かせる
-    def dt(x):
-        try:
-            return date_parser.parse(x["published_at"])
-        except Exception:
-            return datetime.now(timezone.utc)
-
-    items.sort(key=lambda x: (x["priority"], -dt(x).timestamp()))
+    # 新しさ優先、ただし priority は強く効かせる（収集時に計算済みの epoch で比較）
+    items.sort(key=lambda x: (x["priority"], -x["_ts"]))
+    for it in items:
+        del it["_ts"]
     return items[:TOTAL_CANDIDATES]
 
 
@@ -211,13 +323,16 @@ def pick_three_diverse(cands):
     picked = []
     used_sources = set()
 
+    # 枠ごとの候補リスト（candsの並び順＝優先度・新しさ順を保つ）
+    by_bucket = defaultdict(list)
+    for it in cands:
+        by_bucket[it["bucket"]].append(it)
+
     # まず枠を埋める
     for bucket in ["market", "policy", "tech"]:
-        for it in cands:
+        for it in by_bucket[bucket]:
             if it["source"] in used_sources:
                 continue
-            if it["bucket"] != bucket:
-                continue
             picked.append(it)
             used_sources.add(it["source"])
             break
@@ -238,7 +353,10 @@ def pick_three_diverse(cands):
 # =========================
 # OpenAI構造化（任意）
 # =========================
-def openai_structurize(picked_articles):
+_FENCE_RE = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$", re.IGNORECASE)
+
+
+def openai_structurize(picked_articles, now: datetime):
     if not OPENAI_API_KEY:
         return None
 
@@ -249,11 +367,14 @@ def openai_structurize(picked_articles):
         "日本市場の視点（事業・投資・規制・実装）で評価し、スコアを公開してください。"
     )
 
-    date_iso = datetime.now(timezone.utc).date().isoformat()
+    date_iso = now.date().isoformat()
+
+    # 判定に効くのは要約の冒頭だけなので、プロンプトには短くして渡す（トークン節約）
+    articles = [{**a, "summary_raw": a["summary_raw"][:PROMPT_SUMMARY_CHARS]} for a in picked_articles]
 
     user_payload = {
         "date_iso": date_iso,
-        "articles": picked_articles,
+        "articles": articles,
         "score_rule": {
             "importance_score": "0-100",
             "breakdown": {
@@ -297,29 +418,31 @@ def openai_structurize(picked_articles):
 }}
 
 入力:
-{json.dumps(user_payload, ensure_ascii=False)}
+{orjson.dumps(user_payload).decode("utf-8")}
 """.strip()
 
-    r = requests.post(
+    body = {
+        "model": OPENAI_MODEL,
+        "temperature": 0.2,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt},
+        ],
+    }
+
+    # orjsonはUTF-8のままbytesを出すので、日本語が \uXXXX に膨らまない
+    r = SESSION.post(
         "https://api.openai.com/v1/chat/completions",
         headers={"Content-Type": "application/json", "Authorization": f"Bearer {OPENAI_API_KEY}"},
-        json={
-            "model": OPENAI_MODEL,
-            "temperature": 0.2,
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt},
-            ],
-        },
+        data=orjson.dumps(body),
         timeout=40,
     )
     r.raise_for_status()
     data = r.json()
     raw = data["choices"][0]["message"]["content"].strip()
 
-    raw = re.sub(r"^```json\s*", "", raw, flags=re.I).strip()
-    raw = re.sub(r"^```\s*", "", raw, flags=re.I).strip()
-    raw = re.sub(r"```$", "", raw, flags=re.I).strip()
+    # 先頭の ```json / ``` と末尾の ``` を1回の走査で除去
+    raw = _FENCE_RE.sub("", raw).strip()
 
     return json.loads(raw)
 
@@ -329,14 +452,25 @@ def ensure_dirs():
     os.makedirs(ARCHIVE_DIR, exist_ok=True)
 
 
-def write_json(payload, path):
+def write_json(payload, *paths):
+    # シリアライズは1回だけ、同じbytesを各パスへ書く（.gz で終わるパスはgzip圧縮）
     ensure_dirs()
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(payload, f, ensure_ascii=False, indent=2)
+    data = json.dumps(payload, ensure_ascii=False, indent=2).encode("utf-8")
+    gz = None
+    for path in paths:
+        if path.endswith(".gz"):
+            if gz is None:
+                # mtime=0 で出力を決定的にする（内容が同じなら差分コミットが出ない）
+                gz = gzip.compress(data, compresslevel=6, mtime=0)
+            out = gz
+        else:
+            out = data
+        with open(path, "wb") as f:
+            f.write(out)
 
 
-def fallback_payload(picked):
-    date_iso = datetime.now(timezone.utc).date().isoformat()
+def fallback_payload(picked, now: datetime):
+    date_iso = now.date().isoformat()
 
     def mk(a):
         return {
@@ -357,7 +491,7 @@ def fallback_payload(picked):
     payload = {
         "date_iso": date_iso,
         "items": [mk(a) for a in picked],
-        "generated_at": datetime.now(timezone.utc).isoformat(),
+        "generated_at": now.isoformat(),
         "version": "B1-RSS-Fallback-1.0",
         "sources": sorted(list({a["source"] for a in picked})),
     }
@@ -365,30 +499,32 @@ def fallback_payload(picked):
 
 
 def main():
-    cands = collect_candidates()
+    # 実行時刻は1回だけ取得して使い回す（エントリ間・出力間で時刻がずれない）
+    now = datetime.now(timezone.utc)
+
+    cands = collect_candidates(now)
     picked = pick_three_diverse(cands)
 
     # OpenAIがあれば構造化、失敗したらフォールバック
     payload = None
     try:
-        structured = openai_structurize(picked)
+        structured = openai_structurize(picked, now)
         if structured and isinstance(structured, dict) and isinstance(structured.get("items"), list) and len(structured["items"]) == 3:
             payload = structured
-            payload["generated_at"] = datetime.now(timezone.utc).isoformat()
+            payload["generated_at"] = now.isoformat()
             payload["version"] = "B1-RSS-OpenAI-1.0"
             payload["sources"] = sorted(list({it.get("source") for it in payload["items"] if it.get("source")}))
         else:
-            payload = fallback_payload(picked)
+            payload = fallback_payload(picked, now)
     except Exception as e:
         print(f"[WARN] OpenAI failed -> fallback: {e}")
-        payload = fallback_payload(picked)
+        payload = fallback_payload(picked, now)
 
     # 保存
-    date_iso = payload.get("date_iso") or datetime.now(timezone.utc).date().isoformat()
-    write_json(payload, OUT_PATH)
-    write_json(payload, f"{ARCHIVE_DIR}/{date_iso}.json")
+    date_iso = payload.get("date_iso") or now.date().isoformat()
+    write_json(payload, OUT_PATH, f"{ARCHIVE_DIR}/{date_iso}.json.gz")
 
-    print(f"[OK] wrote {OUT_PATH} and archive/{date_iso}.json")
+    print(f"[OK] wrote {OUT_PATH} and archive/{date_iso}.json.gz")
     print(f"[INFO] sources: {payload.get('sources')}")
 
 